@@ -1,39 +1,75 @@
 # ============================================================
 # 🤖 WhatsApp AI Gizi Anak – Chatbot Persona Aira
 # ============================================================
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from collections import Counter, deque
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from requests.adapters import HTTPAdapter
+from stream_shaper import StreamShaper, clean_reply
 import requests
 import google.generativeai as genai
+import atexit
+import hashlib
+import json
 import logging
+import math
 import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+import uuid
 
 # ------------------------------------------------------------
 # 🔧 KONFIGURASI DASAR
 # ------------------------------------------------------------
 app = Flask(__name__)
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler("whatsapp-bot.log"),
-        logging.StreamHandler()
-    ]
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 5))
+CONV_LOG_PATH = os.getenv("CONV_LOG_PATH", "conversations.jsonl")
+
+
+def start_log_listener(queue_: queue.Queue, *handlers) -> QueueListener:
+    # Tulis file di thread terpisah supaya request tidak menunggu disk
+    listener = QueueListener(queue_, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+_log_queue = queue.Queue(-1)
+_log_format = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+_log_file = RotatingFileHandler(
+    "whatsapp-bot.log", maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
 )
+_log_stream = logging.StreamHandler()
+for _handler in (_log_file, _log_stream):
+    _handler.setFormatter(_log_format)
+start_log_listener(_log_queue, _log_file, _log_stream)
+
+# QueueHandler hanya meneruskan pesan; format lengkap dipasang di handler tujuan
+_log_enqueue = QueueHandler(_log_queue)
+_log_enqueue.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=logging.INFO, handlers=[_log_enqueue])
+
+# Log percakapan ringkas (JSONL, satu record per baris)
+_conv_queue = queue.Queue(-1)
+conv_logger = logging.getLogger("aira.conv")
+conv_logger.propagate = False
+conv_logger.setLevel(logging.INFO)
+conv_logger.addHandler(QueueHandler(_conv_queue))
+start_log_listener(_conv_queue, RotatingFileHandler(
+    CONV_LOG_PATH, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+))
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
 FONNTE_TOKEN = os.getenv("FONNTE_TOKEN", "")
 
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel("gemini-2.5-flash")
-
-# ------------------------------------------------------------
-# 🧠 FUNGSI RESPON AI
-# ------------------------------------------------------------
-def get_ai_response(user_message: str) -> str:
-    try:
-        prompt = f"""
-Kamu adalah AI Gizi Anak bernama *Aira Nutria*.
+# Persona statis dikirim sebagai system instruction, dibangun sekali saat start
+SYSTEM_INSTRUCTION = """Kamu adalah AI Gizi Anak bernama *Aira Nutria*.
 
 🎀 Profil Aira:
 • Nama lengkap: Aira Nutria
@@ -57,43 +93,1505 @@ Kamu adalah AI Gizi Anak bernama *Aira Nutria*.
 • Jika pertanyaan di luar topik, jawab:
   "Maaf ya, Aira hanya fokus membahas nutrisi dan gizi anak 😊"
 • Jika ditanya nama / umur / asal / siapa pencipta → jawab sesuai profil
+"""
+
+# Backend "stub" dipakai benchmark/uji lokal: tidak memanggil Gemini/Fonnte sungguhan
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini")
+FONNTE_BACKEND = os.getenv("FONNTE_BACKEND", "http")
+
+if LLM_BACKEND == "stub":
+    from stub_backends import StubModel
+
+    model = StubModel(
+        latency_ms=float(os.getenv("STUB_LLM_LATENCY_MS", 800)),
+        dist=os.getenv("STUB_LLM_LATENCY_DIST", "fixed"),
+        error_rate=float(os.getenv("STUB_LLM_ERROR_RATE", 0)),
+    )
+else:
+    genai.configure(api_key=GEMINI_API_KEY)
+    model = genai.GenerativeModel("gemini-2.5-flash", system_instruction=SYSTEM_INSTRUCTION)
+
+# Penyimpanan lokal bersama (dipakai semua worker gunicorn)
+AIRA_DB_PATH = os.getenv("AIRA_DB_PATH", "aira.db")
+
+# Mode asinkron: webhook langsung balas 200, AI + kirim dikerjakan worker
+ASYNC_MODE = os.getenv("ASYNC_MODE", "0") == "1"
+QUEUE_MAX_SIZE = int(os.getenv("QUEUE_MAX_SIZE", 500))
+QUEUE_WORKERS = int(os.getenv("QUEUE_WORKERS", 4))
+QUEUE_POLL_SEC = float(os.getenv("QUEUE_POLL_SEC", 0.5))
+QUEUE_LEASE_SEC = float(os.getenv("QUEUE_LEASE_SEC", 120))
+QUEUE_MAX_ATTEMPTS = int(os.getenv("QUEUE_MAX_ATTEMPTS", 3))
+QUEUE_DRAIN_TIMEOUT = float(os.getenv("QUEUE_DRAIN_TIMEOUT", 25))
+
+# Cache balasan AI untuk pertanyaan yang sering diulang
+REPLY_CACHE_ENABLED = os.getenv("REPLY_CACHE_ENABLED", "1") == "1"
+REPLY_CACHE_MAX_ENTRIES = int(os.getenv("REPLY_CACHE_MAX_ENTRIES", 2000))
+REPLY_CACHE_TTL_SEC = float(os.getenv("REPLY_CACHE_TTL_SEC", 86400))
+REPLY_CACHE_STOPWORDS = os.getenv("REPLY_CACHE_STOPWORDS", "0") == "1"
+
+# Pengirim Fonnte: koneksi pooled, rate limit, retry, dead-letter
+FONNTE_SEND_URL = os.getenv("FONNTE_SEND_URL", "https://api.fonnte.com/send")
+FONNTE_RATE_PER_SEC = float(os.getenv("FONNTE_RATE_PER_SEC", 5))
+FONNTE_RATE_BURST = float(os.getenv("FONNTE_RATE_BURST", 5))
+FONNTE_TIMEOUT_SEC = float(os.getenv("FONNTE_TIMEOUT_SEC", 10))
+FONNTE_MAX_RETRIES = int(os.getenv("FONNTE_MAX_RETRIES", 3))
+FONNTE_BACKOFF_SEC = float(os.getenv("FONNTE_BACKOFF_SEC", 0.5))
+FONNTE_POOL_SIZE = int(os.getenv("FONNTE_POOL_SIZE", 10))
+FONNTE_DEADLETTER_PATH = os.getenv("FONNTE_DEADLETTER_PATH", "fonnte-deadletter.jsonl")
+
+# Router lokal: sapaan, identitas, di luar topik, dan FAQ tanpa memanggil Gemini
+ROUTER_ENABLED = os.getenv("ROUTER_ENABLED", "1") == "1"
+FAQ_PATH = os.getenv("FAQ_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "faq_gizi.json"))
+FAQ_MIN_CONFIDENCE = float(os.getenv("FAQ_MIN_CONFIDENCE", 0.75))
+FAQ_MIN_MATCHED_TERMS = int(os.getenv("FAQ_MIN_MATCHED_TERMS", 2))
+GREETING_MAX_WORDS = int(os.getenv("GREETING_MAX_WORDS", 4))
 
-📩 Pesan pengguna:
-"{user_message}"
+# Streaming: balasan dikirim per potongan begitu siap
+STREAM_MODE = os.getenv("STREAM_MODE", "0") == "1"
+STREAM_CHUNK_MIN_CHARS = int(os.getenv("STREAM_CHUNK_MIN_CHARS", 300))
+STREAM_CHUNK_MAX_CHARS = int(os.getenv("STREAM_CHUNK_MAX_CHARS", 1000))
+MAX_REPLY_WORDS = 200
+
+# Memori percakapan per pengirim
+HISTORY_ENABLED = os.getenv("HISTORY_ENABLED", "1") == "1"
+HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", 12))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", 800))
+HISTORY_IDLE_SEC = float(os.getenv("HISTORY_IDLE_SEC", 6 * 3600))
+HISTORY_MAX_SENDERS = int(os.getenv("HISTORY_MAX_SENDERS", 5000))
+HISTORY_MAX_BYTES = int(os.getenv("HISTORY_MAX_BYTES", 8 * 1024 * 1024))
+HISTORY_EVICT_INTERVAL_SEC = float(os.getenv("HISTORY_EVICT_INTERVAL_SEC", 60))
+
+# Gabung pesan beruntun (debounce) & abaikan webhook yang dikirim ulang
+DEBOUNCE_SEC = float(os.getenv("DEBOUNCE_SEC", 0))
+DEBOUNCE_MAX_WAIT_SEC = float(os.getenv("DEBOUNCE_MAX_WAIT_SEC", 10))
+DEDUP_TTL_SEC = float(os.getenv("DEDUP_TTL_SEC", 600))
+
+# Admission control: rate limit per pengirim, batas panggilan Gemini, circuit breaker
+SENDER_RATE_PER_MIN = float(os.getenv("SENDER_RATE_PER_MIN", 6))
+SENDER_BURST = float(os.getenv("SENDER_BURST", 5))
+SENDER_BUCKET_CLEANUP_SEC = float(os.getenv("SENDER_BUCKET_CLEANUP_SEC", 60))
+LLM_MAX_INFLIGHT = int(os.getenv("LLM_MAX_INFLIGHT", 4))
+LLM_SLOT_WAIT_SEC = float(os.getenv("LLM_SLOT_WAIT_SEC", 2))
+LLM_SLOT_LEASE_SEC = float(os.getenv("LLM_SLOT_LEASE_SEC", 90))
+LLM_SLO_SEC = float(os.getenv("LLM_SLO_SEC", 20))
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", 5))
+BREAKER_COOLDOWN_SEC = float(os.getenv("BREAKER_COOLDOWN_SEC", 30))
+BREAKER_FAQ_MIN_CONFIDENCE = float(os.getenv("BREAKER_FAQ_MIN_CONFIDENCE", 0.5))
+
+# Metrik Prometheus, snapshot tiap worker digabung lewat SQLite
+METRICS_FLUSH_SEC = float(os.getenv("METRICS_FLUSH_SEC", 5))
+
+TRIGGER = "@aigizi"
+FALLBACK_REPLY = "_Maaf, sistem sedang sibuk. Coba lagi nanti ya 🙏_"
+
+# ------------------------------------------------------------
+# 🗄️ PENYIMPANAN BERSAMA (SQLite)
+# ------------------------------------------------------------
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sender TEXT NOT NULL,
+    message TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    created_at REAL NOT NULL,
+    available_at REAL NOT NULL DEFAULT 0,
+    started_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, id);
+
+CREATE TABLE IF NOT EXISTS seen_messages (
+    digest TEXT PRIMARY KEY,
+    ts REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_seen_messages_ts ON seen_messages(ts);
+
+CREATE TABLE IF NOT EXISTS reply_cache (
+    key TEXT PRIMARY KEY,
+    reply TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_hit REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_reply_cache_last_hit ON reply_cache(last_hit);
+
+CREATE TABLE IF NOT EXISTS rate_buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS turns (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sender TEXT NOT NULL,
+    role TEXT NOT NULL,
+    text TEXT NOT NULL,
+    ts REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_turns_sender ON turns(sender, id);
+
+CREATE TABLE IF NOT EXISTS llm_slots (
+    token TEXT PRIMARY KEY,
+    acquired_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS breaker (
+    name TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    failures INTEGER NOT NULL,
+    changed_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS metrics_snapshots (
+    worker TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+);
 """
 
-        response = model.generate_content(
-            prompt,
-            generation_config={"max_output_tokens": 350}
+_db_local = threading.local()
+
+
+def get_db() -> sqlite3.Connection:
+    # Satu koneksi per thread; WAL supaya baca/tulis antar proses tidak saling blok
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(AIRA_DB_PATH, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _db_local.conn = conn
+    return conn
+
+
+@contextmanager
+def db_transaction():
+    db = get_db()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield db
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+
+def incr_counter(name: str, amount: int = 1):
+    get_db().execute(
+        "INSERT INTO counters (name, value) VALUES (?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+        (name, amount),
+    )
+
+
+def read_counters(prefix: str) -> dict:
+    rows = get_db().execute(
+        "SELECT name, value FROM counters WHERE name LIKE ?", (prefix + "%",)
+    ).fetchall()
+    return {name[len(prefix):]: value for name, value in rows}
+
+
+def take_token(key: str, rate: float, burst: float) -> float:
+    """Ambil 1 token dari bucket bersama; hasil 0 jika boleh lanjut, selain itu detik tunggu."""
+    now = time.time()
+    with db_transaction() as db:
+        row = db.execute(
+            "SELECT tokens, updated_at FROM rate_buckets WHERE key = ?", (key,)
+        ).fetchone()
+        tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        db.execute(
+            "INSERT OR REPLACE INTO rate_buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+            (key, tokens, now),
         )
+    return wait
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+_latency_lock = threading.Lock()
+_latencies = {}
+
+
+def record_latency(name: str, seconds: float):
+    with _latency_lock:
+        _latencies.setdefault(name, deque(maxlen=2000)).append(seconds)
+
+
+def latency_stats() -> dict:
+    with _latency_lock:
+        snapshot = {name: list(values) for name, values in _latencies.items()}
+    return {
+        name: {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 0.50) * 1000, 1),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 1),
+        }
+        for name, values in snapshot.items()
+    }
+
+
+def migrate_db():
+    # Kolom yang ditambahkan setelah tabel dibuat di versi sebelumnya
+    columns = {row[1] for row in get_db().execute("PRAGMA table_info(jobs)")}
+    if "available_at" not in columns:
+        get_db().execute("ALTER TABLE jobs ADD COLUMN available_at REAL NOT NULL DEFAULT 0")
+
+
+get_db().executescript(SCHEMA)
+migrate_db()
+
+# ------------------------------------------------------------
+# ♻️ CACHE BALASAN
+# ------------------------------------------------------------
+STOPWORDS_ID = frozenset("""
+yang dan di ke dari untuk dengan ini itu ya kak dong sih nih deh kok aja saja
+ada adalah atau juga mau tolong mohon min admin bu pak bun bunda
+""".split())
+
+_PUNCT_RE = re.compile(r"[^\w\s]+")
+
+
+def normalize_message(message: str) -> str:
+    text = _PUNCT_RE.sub(" ", message.lower().replace(TRIGGER, " "))
+    words = text.split()
+    if REPLY_CACHE_STOPWORDS:
+        words = [w for w in words if w not in STOPWORDS_ID]
+    return " ".join(words)
+
+
+def cache_get(key: str):
+    try:
+        now = time.time()
+        db = get_db()
+        row = db.execute(
+            "SELECT reply, created_at FROM reply_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or now - row[1] > REPLY_CACHE_TTL_SEC:
+            incr_counter("cache:misses")
+            return None
+        db.execute("UPDATE reply_cache SET last_hit = ? WHERE key = ?", (now, key))
+        incr_counter("cache:hits")
+        return row[0]
+    except sqlite3.Error:
+        logging.exception("⚠️ Gagal membaca cache balasan:")
+        return None
+
+
+def cache_put(key: str, reply: str):
+    # Eviksi: buang yang kedaluwarsa, lalu yang paling lama tidak dipakai (LRU)
+    try:
+        now = time.time()
+        with db_transaction() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO reply_cache (key, reply, created_at, last_hit) "
+                "VALUES (?, ?, ?, ?)",
+                (key, reply, now, now),
+            )
+            db.execute(
+                "DELETE FROM reply_cache WHERE created_at < ?",
+                (now - REPLY_CACHE_TTL_SEC,),
+            )
+            db.execute(
+                "DELETE FROM reply_cache WHERE key IN ("
+                "SELECT key FROM reply_cache ORDER BY last_hit DESC LIMIT -1 OFFSET ?)",
+                (REPLY_CACHE_MAX_ENTRIES,),
+            )
+    except sqlite3.Error:
+        logging.exception("⚠️ Gagal menyimpan cache balasan:")
+
+
+def cache_stats() -> dict:
+    (entries,) = get_db().execute("SELECT COUNT(*) FROM reply_cache").fetchone()
+    counters = read_counters("cache:")
+    hits, misses = counters.get("hits", 0), counters.get("misses", 0)
+    return {
+        "enabled": REPLY_CACHE_ENABLED,
+        "entries": entries,
+        "max_entries": REPLY_CACHE_MAX_ENTRIES,
+        "ttl_sec": REPLY_CACHE_TTL_SEC,
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": round(hits / (hits + misses), 3) if hits + misses else 0.0,
+    }
+
+# ------------------------------------------------------------
+# 🧠 FUNGSI RESPON AI
+# ------------------------------------------------------------
+def build_contents(sender, user_message: str):
+    """Riwayat (dipangkas ke budget token) + pesan baru, format contents Gemini."""
+    turns = trim_history(conversation_history(sender), HISTORY_TOKEN_BUDGET) if sender else []
+    contents = [{"role": t.role, "parts": [t.text]} for t in turns]
+    contents.append({"role": "user", "parts": [user_message]})
+    return contents, len(turns)
 
-        text = response.text.strip()
-        words = text.split()
-        if len(words) > 200:
-            text = " ".join(words[:200]) + "..."
 
-        return text.replace("**", "").replace("--", "")
+def log_prompt_tokens(sender, response, history_turns: int):
+    usage = getattr(response, "usage_metadata", None)
+    tokens = getattr(usage, "prompt_token_count", None)
+    if tokens:
+        logging.info(f"🧮 Prompt tokens sender={sender} tokens={tokens} history_turns={history_turns}")
+
+
+def reply_cache_key(user_message: str, history_turns: int) -> str:
+    # Jawaban yang bergantung pada riwayat tidak boleh dipakai pengirim lain
+    if not REPLY_CACHE_ENABLED or history_turns:
+        return ""
+    return normalize_message(user_message)
+
+
+def get_ai_response(user_message: str, sender: str = None) -> str:
+    contents, history_turns = build_contents(sender, user_message)
+    cache_key = reply_cache_key(user_message, history_turns)
+    if cache_key:
+        cached = cache_get(cache_key)
+        if cached is not None:
+            if sender:
+                remember_exchange(sender, user_message, cached)
+            return cached
+
+    try:
+        with llm_guard(), track_stage("llm"):
+            start = time.perf_counter()
+            response = model.generate_content(
+                contents,
+                generation_config={"max_output_tokens": 350}
+            )
+            record_latency("ttfb_buffered", time.perf_counter() - start)
+            log_prompt_tokens(sender, response, history_turns)
+            text = response.text.strip()
+
+        with track_stage("postprocess"):
+            words = text.split()
+            if len(words) > MAX_REPLY_WORDS:
+                text = " ".join(words[:MAX_REPLY_WORDS]) + "..."
+
+            text = clean_reply(text)
+
+    except LlmUnavailable as e:
+        logging.warning(f"🚦 Gemini dilewati: {e}")
+        metrics.error("llm")
+        return degraded_reply(user_message)
 
     except Exception as e:
         logging.exception("⚠️ Error detail Gemini:")
-        return "_Maaf, sistem sedang sibuk. Coba lagi nanti ya 🙏_"
+        return FALLBACK_REPLY
 
+    # Hanya jawaban sukses yang di-cache, balasan fallback tidak pernah disimpan
+    if cache_key:
+        cache_put(cache_key, text)
+    if sender:
+        remember_exchange(sender, user_message, text)
+    return text
+
+# ------------------------------------------------------------
+# 🌊 STREAMING GEMINI
+# ------------------------------------------------------------
+def stream_ai_response(sender: str, user_message: str, started: float):
+    """Kirim balasan Gemini per potongan; kembalikan (balasan utuh, hasil kirim terakhir)."""
+    contents, history_turns = build_contents(sender, user_message)
+    cache_key = reply_cache_key(user_message, history_turns)
+    if cache_key:
+        cached = cache_get(cache_key)
+        if cached is not None:
+            remember_exchange(sender, user_message, cached)
+            result = send_message_to_fonnte(sender, cached)
+            record_latency("first_send_stream", time.perf_counter() - started)
+            return cached, result
+
+    shaper = StreamShaper(MAX_REPLY_WORDS, STREAM_CHUNK_MIN_CHARS, STREAM_CHUNK_MAX_CHARS)
+    results = []
+
+    # Kirim di thread terpisah: slot Gemini & stage "llm" tidak ikut menunggu Fonnte
+    pieces = queue.Queue()
+
+    def send_pieces():
+        while True:
+            piece = pieces.get()
+            if piece is None:
+                return
+            results.append(send_message_to_fonnte(sender, piece))
+            if len(results) == 1:
+                record_latency("first_send_stream", time.perf_counter() - started)
+
+    sender_thread = threading.Thread(target=send_pieces, name="aira-stream-send", daemon=True)
+    sender_thread.start()
+
+    outcome = "ok"
+    try:
+        with llm_guard() as call, track_stage("llm"):
+            start = time.perf_counter()
+            response = model.generate_content(
+                contents,
+                generation_config={"max_output_tokens": 350},
+                stream=True,
+            )
+            for i, chunk in enumerate(response):
+                if i == 0:
+                    call["latency"] = time.perf_counter() - start
+                    record_latency("ttfb_stream", call["latency"])
+                    log_prompt_tokens(sender, chunk, history_turns)
+                for piece in shaper.feed(chunk.text):
+                    pieces.put(piece)
+                if shaper.done:
+                    # Batas kata tercapai: berhenti membaca, sisa stream ditinggalkan
+                    break
+        for piece in shaper.finish():
+            pieces.put(piece)
+
+    except LlmUnavailable as e:
+        logging.warning(f"🚦 Gemini dilewati: {e}")
+        metrics.error("llm")
+        outcome = "degraded"
+
+    except Exception as e:
+        logging.exception("⚠️ Error detail Gemini (stream):")
+        outcome = "error"
+
+    finally:
+        pieces.put(None)
+        sender_thread.join()
+
+    if outcome == "degraded":
+        reply = degraded_reply(user_message)
+        return reply, send_message_to_fonnte(sender, reply)
+
+    if not results:
+        return FALLBACK_REPLY, send_message_to_fonnte(sender, FALLBACK_REPLY)
+
+    reply = shaper.text.strip()
+    if outcome == "ok":
+        if cache_key:
+            cache_put(cache_key, reply)
+        remember_exchange(sender, user_message, reply)
+    return reply, results[-1]
 
 # ------------------------------------------------------------
 # 📤 KIRIM KE FONNTE
 # ------------------------------------------------------------
-def send_message_to_fonnte(phone: str, message: str):
-    url = "https://api.fonnte.com/send"
-    headers = {"Authorization": FONNTE_TOKEN}
-    data = {"target": phone, "message": message, "countryCode": "62"}
+class FonnteSender:
+    def __init__(self, url: str, token: str, rate_per_sec: float = 0, burst: float = 1,
+                 timeout: float = 10, max_retries: int = 3, backoff_sec: float = 0.5,
+                 pool_size: int = 10, deadletter_path: str = ""):
+        self.url = url
+        self.rate_per_sec = rate_per_sec
+        self.burst = max(1.0, burst)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_sec = backoff_sec
+        self.deadletter_path = deadletter_path
+
+        # Satu session keep-alive dipakai ulang, tidak buka koneksi TLS tiap kirim
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["Authorization"] = token
+
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=2000)
+        self._sent = 0
+        self._failed = 0
+        self._dead = 0
+        self._first_send = None
+
+    def send(self, target: str, message: str):
+        data = {"target": target, "message": message, "countryCode": "62"}
+        error = ""
+
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.backoff_sec * 2 ** (attempt - 1))
+            self._wait_rate()
+
+            start = time.perf_counter()
+            try:
+                resp = self.session.post(self.url, data=data, timeout=self.timeout)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                error = str(e)
+                logging.warning(f"🔁 Fonnte timeout/koneksi gagal (percobaan {attempt + 1}): {e}")
+                continue
+            finally:
+                self._record_latency(time.perf_counter() - start)
+
+            if resp.status_code >= 500:
+                error = f"HTTP {resp.status_code}"
+                logging.warning(f"🔁 Fonnte membalas {resp.status_code} (percobaan {attempt + 1})")
+                continue
+
+            try:
+                resp.raise_for_status()
+                result = resp.json()
+            except Exception as e:
+                # 4xx / balasan rusak tidak akan membaik dengan retry
+                logging.exception("❌ Gagal mengirim pesan ke Fonnte:")
+                self._count("_failed")
+                return {"sent": False, "error": str(e)}
+
+            self._count("_sent")
+            return result
+
+        self._count("_failed")
+        self._dead_letter(data, error)
+        return {"sent": False, "error": error}
+
+    def stats(self) -> dict:
+        with self._lock:
+            latencies = list(self._latencies)
+            sent, failed, dead = self._sent, self._failed, self._dead
+            elapsed = time.time() - self._first_send if self._first_send else 0.0
+        return {
+            "sent": sent,
+            "failed": failed,
+            "dead_letters": dead,
+            "sends_per_sec": round(sent / elapsed, 3) if elapsed > 0 else 0.0,
+            "latency_p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+            "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+            "rate_per_sec": self.rate_per_sec,
+        }
+
+    def _wait_rate(self):
+        # Batas kirim per detik dibagi semua worker lewat bucket di SQLite
+        if self.rate_per_sec <= 0:
+            return
+        while True:
+            wait = take_token("fonnte:send", self.rate_per_sec, self.burst)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def _record_latency(self, seconds: float):
+        with self._lock:
+            self._latencies.append(seconds)
+            if self._first_send is None:
+                self._first_send = time.time()
+
+    def _count(self, attr: str):
+        with self._lock:
+            setattr(self, attr, getattr(self, attr) + 1)
 
+    def _dead_letter(self, data: dict, error: str):
+        logging.error(f"☠️ Pesan ke {data['target']} gagal setelah {self.max_retries + 1} percobaan: {error}")
+        if not self.deadletter_path:
+            return
+        record = {"ts": time.time(), "target": data["target"], "message": data["message"], "error": error}
+        with self._lock:
+            self._dead += 1
+            with open(self.deadletter_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+if FONNTE_BACKEND == "stub":
+    from stub_backends import StubSender
+
+    fonnte_sender = StubSender(
+        latency_ms=float(os.getenv("STUB_FONNTE_LATENCY_MS", 150)),
+        dist=os.getenv("STUB_FONNTE_LATENCY_DIST", "fixed"),
+        error_rate=float(os.getenv("STUB_FONNTE_ERROR_RATE", 0)),
+    )
+else:
+    fonnte_sender = FonnteSender(
+        FONNTE_SEND_URL,
+        FONNTE_TOKEN,
+        rate_per_sec=FONNTE_RATE_PER_SEC,
+        burst=FONNTE_RATE_BURST,
+        timeout=FONNTE_TIMEOUT_SEC,
+        max_retries=FONNTE_MAX_RETRIES,
+        backoff_sec=FONNTE_BACKOFF_SEC,
+        pool_size=FONNTE_POOL_SIZE,
+        deadletter_path=FONNTE_DEADLETTER_PATH,
+    )
+
+
+def send_message_to_fonnte(phone: str, message: str):
+    start = time.perf_counter()
     try:
-        resp = requests.post(url, headers=headers, data=data, timeout=10)
-        resp.raise_for_status()
-        return resp.json()
+        result = fonnte_sender.send(phone, message)
     except Exception as e:
         logging.exception("❌ Gagal mengirim pesan ke Fonnte:")
-        return {"sent": False, "error": str(e)}
+        result = {"sent": False, "error": str(e)}
+
+    metrics.observe("send", time.perf_counter() - start)
+    if send_failed(result):
+        metrics.error("send")
+    return result
+
+# ------------------------------------------------------------
+# 🧠 MEMORI PERCAKAPAN
+# ------------------------------------------------------------
+class Turn:
+    __slots__ = ("role", "text")
+
+    def __init__(self, role: str, text: str):
+        self.role = role
+        self.text = text
+
+
+def estimate_tokens(text: str) -> int:
+    # Perkiraan kasar ~4 karakter per token, cukup untuk memangkas riwayat
+    return len(text) // 4 + 1
+
+
+def conversation_history(sender: str):
+    if not HISTORY_ENABLED:
+        return []
+    try:
+        rows = get_db().execute(
+            "SELECT role, text FROM turns WHERE sender = ? AND ts >= ? ORDER BY id",
+            (sender, time.time() - HISTORY_IDLE_SEC),
+        ).fetchall()
+    except sqlite3.Error:
+        logging.exception("⚠️ Gagal membaca riwayat percakapan:")
+        return []
+    return [Turn(role, text) for role, text in rows]
+
+
+def trim_history(turns, budget: int):
+    # Ambil giliran terbaru selama masih muat; riwayat selalu dimulai dari giliran user
+    kept, used = [], 0
+    for turn in reversed(turns):
+        used += estimate_tokens(turn.text)
+        if used > budget:
+            break
+        kept.append(turn)
+    kept.reverse()
+    while kept and kept[0].role != "user":
+        kept.pop(0)
+    return kept
+
+
+def remember_exchange(sender: str, user_message: str, reply: str):
+    if not HISTORY_ENABLED:
+        return
+    try:
+        now = time.time()
+        with db_transaction() as db:
+            is_new = db.execute("SELECT 1 FROM turns WHERE sender = ? LIMIT 1", (sender,)).fetchone() is None
+            db.executemany(
+                "INSERT INTO turns (sender, role, text, ts) VALUES (?, ?, ?, ?)",
+                [(sender, "user", user_message, now), (sender, "model", reply, now)],
+            )
+            # Ring buffer: simpan hanya N giliran terakhir per pengirim
+            stale = (
+                "FROM turns WHERE sender = ? AND id NOT IN ("
+                "SELECT id FROM turns WHERE sender = ? ORDER BY id DESC LIMIT ?)"
+            )
+            args = (sender, sender, HISTORY_MAX_TURNS)
+            (trimmed,) = db.execute(
+                f"SELECT COALESCE(SUM(LENGTH(CAST(text AS BLOB))), 0) {stale}", args
+            ).fetchone()
+            db.execute(f"DELETE {stale}", args)
+
+            # Total berjalan di counters: batas global dicek tiap simpan tanpa scan seluruh tabel
+            added = len(user_message.encode("utf-8")) + len(reply.encode("utf-8"))
+            incr_counter("history:bytes", added - trimmed)
+            if is_new:
+                incr_counter("history:senders")
+            totals = read_counters("history:")
+            if totals.get("senders", 0) > HISTORY_MAX_SENDERS or totals.get("bytes", 0) > HISTORY_MAX_BYTES:
+                evict_idle_senders(db, now)
+    except sqlite3.Error:
+        logging.exception("⚠️ Gagal menyimpan riwayat percakapan:")
+        return
+    maybe_evict_history(now)
+
+
+_history_evict_lock = threading.Lock()
+_history_evicted_at = 0.0
+
+
+def maybe_evict_history(now: float):
+    # Buang pengirim idle & koreksi total berjalan; butuh scan seluruh tabel, jadi cukup sesekali
+    global _history_evicted_at
+    with _history_evict_lock:
+        if now - _history_evicted_at < HISTORY_EVICT_INTERVAL_SEC:
+            return
+        _history_evicted_at = now
+    try:
+        with db_transaction() as db:
+            evict_idle_senders(db, now)
+    except sqlite3.Error:
+        logging.exception("⚠️ Gagal membersihkan riwayat percakapan:")
+
+
+def evict_idle_senders(db, now: float):
+    db.execute(
+        "DELETE FROM turns WHERE sender IN ("
+        "SELECT sender FROM turns GROUP BY sender HAVING MAX(ts) < ?)",
+        (now - HISTORY_IDLE_SEC,),
+    )
+    rows = db.execute(
+        "SELECT sender, SUM(LENGTH(CAST(text AS BLOB))) FROM turns "
+        "GROUP BY sender ORDER BY MAX(ts) DESC, MAX(id) DESC"
+    ).fetchall()
+    kept, size = len(rows), sum(r[1] for r in rows)
+
+    # LRU: bila lewat batas, buang pengirim paling lama diam sampai 90% batas,
+    # supaya pengirim baru berikutnya tidak langsung memicu scan lagi
+    if kept > HISTORY_MAX_SENDERS or size > HISTORY_MAX_BYTES:
+        max_senders, max_bytes = int(HISTORY_MAX_SENDERS * 0.9), HISTORY_MAX_BYTES * 0.9
+        kept, size = 0, 0
+        for i, (sender, sender_bytes) in enumerate(rows):
+            if kept >= max_senders or size + sender_bytes > max_bytes:
+                db.executemany("DELETE FROM turns WHERE sender = ?", [(r[0],) for r in rows[i:]])
+                break
+            kept += 1
+            size += sender_bytes
+
+    db.executemany(
+        "INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)",
+        [("history:senders", kept), ("history:bytes", size)],
+    )
+
+
+def history_stats() -> dict:
+    senders, turns, size = get_db().execute(
+        "SELECT COUNT(DISTINCT sender), COUNT(*), COALESCE(SUM(LENGTH(CAST(text AS BLOB))), 0) FROM turns"
+    ).fetchone()
+    return {
+        "enabled": HISTORY_ENABLED,
+        "senders": senders,
+        "turns": turns,
+        "bytes": size,
+        "max_bytes": HISTORY_MAX_BYTES,
+        "token_budget": HISTORY_TOKEN_BUDGET,
+    }
+
+# ------------------------------------------------------------
+# 🧭 ROUTER LOKAL
+# ------------------------------------------------------------
+class PhraseMatcher:
+    """Trie per kata: semua frasa dicocokkan dalam satu kali scan, selalu utuh per kata."""
+
+    def __init__(self, phrases: dict):
+        self.root = {}
+        for label, items in phrases.items():
+            for phrase in items:
+                node = self.root
+                for word in phrase.split():
+                    node = node.setdefault(word, {})
+                node[None] = label
+
+    def find(self, words) -> set:
+        labels = set()
+        for start in range(len(words)):
+            node = self.root
+            for word in words[start:]:
+                node = node.get(word)
+                if node is None:
+                    break
+                if None in node:
+                    labels.add(node[None])
+        return labels
+
+
+GREETING_REPLY = (
+    "👋 Hai! Aku *Aira Nutria*, asisten edukasi gizi anak.\n"
+    "Silakan tanya apa yang ingin kamu ketahui tentang nutrisi & pola makan sehat untuk anak 😊"
+)
+OFF_TOPIC_REPLY = "Maaf ya, Aira hanya fokus membahas nutrisi dan gizi anak 😊"
+
+IDENTITY_REPLIES = {
+    "nama": "Namaku *Aira Nutria* 😊 Asisten edukasi gizi anak berbasis AI.",
+    "umur": "Aira berumur 24 tahun 😊",
+    "pencipta": "Aira dibuat oleh peneliti bernama *GroupFajri-Machine-Learing* 😊",
+    "pendidikan": "Aira lulusan S1 Ilmu Gizi Masyarakat (fiktif) 😊",
+    "hobi": "Hobi Aira membaca jurnal kesehatan, riset MPASI, dan membantu edukasi orang tua 😊",
+}
+
+ROUTER_PHRASES = {
+    "greeting": [
+        "halo", "hai", "hallo", "hi", "hello", "pagi", "siang", "sore", "malam",
+        "selamat pagi", "selamat siang", "selamat sore", "selamat malam",
+        "assalamualaikum", "permisi",
+    ],
+    "nama": [
+        "siapa namamu", "siapa nama kamu", "nama kamu siapa", "namamu siapa",
+        "kamu siapa", "siapa kamu", "nama kamu",
+    ],
+    "umur": ["umur kamu", "umurmu", "usia kamu", "usiamu", "umur aira", "usia aira"],
+    "pencipta": [
+        "siapa pencipta", "penciptamu", "pencipta kamu", "pembuatmu", "pembuat kamu",
+        "siapa yang buat kamu", "siapa yang membuat kamu", "yang bikin kamu",
+    ],
+    "pendidikan": ["pendidikan kamu", "pendidikanmu", "kamu lulusan", "kuliah dimana"],
+    "hobi": ["hobi kamu", "hobimu", "hobi aira"],
+    "off_topic": [
+        "politik", "pemilu", "capres", "presiden", "partai", "sepak bola", "bola",
+        "saham", "crypto", "kripto", "bitcoin", "forex", "trading", "judi", "slot",
+        "togel", "game", "film", "drakor", "lagu", "musik", "pacar", "zodiak",
+        "ramalan", "cuaca", "coding", "pinjol",
+    ],
+    "nutrition": [
+        "anak", "bayi", "balita", "makan", "makanan", "minum", "gizi", "nutrisi",
+        "mpasi", "asi", "susu", "vitamin", "alergi", "protein", "kalsium",
+        "zat besi", "stunting", "berat badan", "menu", "sayur", "buah",
+    ],
+}
+
+FAQ_STOPWORDS = STOPWORDS_ID | frozenset(
+    "apa apakah bagaimana gimana berapa kenapa mengapa kapan boleh bisa tidak "
+    "gak nggak enggak cara tips untuk".split()
+)
+
+
+class FaqIndex:
+    """Indeks BM25 kecil di atas daftar pertanyaan FAQ (satu dokumen per pertanyaan)."""
+
+    def __init__(self, entries, k1: float = 1.2, b: float = 0.75, min_terms: int = 2):
+        self.k1, self.b = k1, b
+        self.min_terms = min_terms
+        self.docs = []
+        for entry in entries:
+            for question in entry["questions"]:
+                self.docs.append((Counter(self.tokenize(question)), entry["answer"]))
+
+        df = Counter()
+        for terms, _ in self.docs:
+            df.update(terms.keys())
+        n = len(self.docs)
+        self.idf = {t: math.log(1 + (n - f + 0.5) / (f + 0.5)) for t, f in df.items()}
+        self.max_idf = max(self.idf.values(), default=1.0)
+        self.avg_len = sum(sum(t.values()) for t, _ in self.docs) / n if n else 1.0
+
+    @staticmethod
+    def tokenize(text: str):
+        return [w for w in _PUNCT_RE.sub(" ", text.lower()).split() if w not in FAQ_STOPWORDS]
+
+    def search(self, text: str):
+        """Kembalikan (jawaban, confidence); confidence = porsi bobot IDF query yang tertutup.
+
+        Query yang cocok kurang dari min_terms kata berbeda dianggap tidak yakin, supaya
+        satu kata umum seperti "susu" tidak langsung dijawab dengan FAQ tertentu.
+        """
+        query = self.tokenize(text)
+        if not query or not self.docs:
+            return None, 0.0
+
+        best, best_score = None, 0.0
+        for terms, answer in self.docs:
+            length = sum(terms.values())
+            score = 0.0
+            for t in query:
+                tf = terms.get(t, 0)
+                if tf:
+                    norm = tf + self.k1 * (1 - self.b + self.b * length / self.avg_len)
+                    score += self.idf[t] * tf * (self.k1 + 1) / norm
+            if score > best_score:
+                best, best_score = (terms, answer), score
+
+        if best is None:
+            return None, 0.0
+        matched = {t for t in query if t in best[0]}
+        if len(matched) < self.min_terms:
+            return None, 0.0
+        total = sum(self.idf.get(t, self.max_idf) for t in query)
+        covered = sum(self.idf[t] for t in query if t in best[0])
+        return best[1], covered / total
+
+
+def load_faq_index(path: str) -> FaqIndex:
+    try:
+        with open(path, encoding="utf-8") as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        logging.exception(f"⚠️ FAQ tidak bisa dibaca dari {path}:")
+        entries = []
+    return FaqIndex(entries, min_terms=FAQ_MIN_MATCHED_TERMS)
+
+
+router_matcher = PhraseMatcher(ROUTER_PHRASES)
+faq_index = load_faq_index(FAQ_PATH)
+
+
+def route_message(message: str):
+    """Kembalikan (route, balasan); balasan None berarti perlu Gemini."""
+    if not ROUTER_ENABLED:
+        return "llm", None
+
+    words = normalize_message(message).split()
+    labels = router_matcher.find(words)
+
+    # Pertanyaan identitas yang dicampur pertanyaan gizi diteruskan ke Gemini (persona tetap menjawab nama/umur)
+    if "nutrition" not in labels:
+        for intent, reply in IDENTITY_REPLIES.items():
+            if intent in labels:
+                return "identity", reply
+
+    # "malam"/"pagi" juga muncul di pertanyaan gizi ("makan malam anak"), jadi sapaan hanya tanpa label gizi
+    if "greeting" in labels and "nutrition" not in labels and len(words) <= GREETING_MAX_WORDS:
+        return "greeting", GREETING_REPLY
+
+    if "off_topic" in labels and "nutrition" not in labels:
+        return "off_topic", OFF_TOPIC_REPLY
+
+    answer, confidence = faq_index.search(message)
+    if answer is not None and confidence >= FAQ_MIN_CONFIDENCE:
+        return "faq", answer
+
+    return "llm", None
+
+
+def router_stats() -> dict:
+    return {
+        "enabled": ROUTER_ENABLED,
+        "faq_min_confidence": FAQ_MIN_CONFIDENCE,
+        "faq_min_matched_terms": FAQ_MIN_MATCHED_TERMS,
+        "faq_questions": len(faq_index.docs),
+        "hits": read_counters("route:"),
+    }
+
+# ------------------------------------------------------------
+# ♊ DEDUP WEBHOOK
+# ------------------------------------------------------------
+def seen_digest(sender: str, message: str, message_id=None) -> str:
+    raw = f"{sender}\x00{message}\x00{message_id or ''}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def mark_seen(sender: str, message: str, message_id=None) -> bool:
+    """Catat payload; False jika payload yang sama sudah diterima dalam TTL."""
+    digest = seen_digest(sender, message, message_id)
+    now = time.time()
+    with db_transaction() as db:
+        db.execute("DELETE FROM seen_messages WHERE ts < ?", (now - DEDUP_TTL_SEC,))
+        cur = db.execute(
+            "INSERT OR IGNORE INTO seen_messages (digest, ts) VALUES (?, ?)", (digest, now)
+        )
+    if cur.rowcount == 0:
+        incr_counter("dedup:duplicates")
+        return False
+    return True
+
+
+def forget_seen(sender: str, message: str, message_id=None):
+    """Hapus catatan payload yang gagal/ditolak supaya kiriman ulang Fonnte tetap diproses."""
+    try:
+        get_db().execute(
+            "DELETE FROM seen_messages WHERE digest = ?", (seen_digest(sender, message, message_id),)
+        )
+    except sqlite3.Error:
+        logging.exception("⚠️ Gagal menghapus catatan dedup:")
+
+
+def dedup_stats() -> dict:
+    counters = read_counters("dedup:")
+    return {
+        "ttl_sec": DEDUP_TTL_SEC,
+        "debounce_sec": DEBOUNCE_SEC if ASYNC_MODE else 0.0,
+        "duplicates": counters.get("duplicates", 0),
+        "merged": counters.get("merged", 0),
+    }
+
+# ------------------------------------------------------------
+# 🚦 ADMISSION CONTROL & CIRCUIT BREAKER
+# ------------------------------------------------------------
+class LlmUnavailable(Exception):
+    pass
+
+
+_bucket_cleanup_lock = threading.Lock()
+_buckets_cleaned_at = 0.0
+
+
+def maybe_cleanup_sender_buckets(rate: float):
+    # Bucket yang sudah penuh kembali tidak perlu disimpan; scan tabel cukup sesekali
+    global _buckets_cleaned_at
+    now = time.time()
+    with _bucket_cleanup_lock:
+        if now - _buckets_cleaned_at < SENDER_BUCKET_CLEANUP_SEC:
+            return
+        _buckets_cleaned_at = now
+    get_db().execute(
+        "DELETE FROM rate_buckets WHERE key LIKE 'sender:%' AND updated_at < ?",
+        (now - SENDER_BURST / rate,),
+    )
+
+
+def allow_sender(sender: str) -> bool:
+    if SENDER_RATE_PER_MIN <= 0:
+        return True
+    rate = SENDER_RATE_PER_MIN / 60
+    maybe_cleanup_sender_buckets(rate)
+    if take_token(f"sender:{sender}", rate, SENDER_BURST) > 0:
+        incr_counter("admission:rate_limited")
+        return False
+    return True
+
+
+def acquire_llm_slot():
+    """Semaphore bersama antar worker; slot milik proses yang mati dilepas lewat lease."""
+    token = uuid.uuid4().hex
+    deadline = time.time() + LLM_SLOT_WAIT_SEC
+    while True:
+        now = time.time()
+        with db_transaction() as db:
+            db.execute("DELETE FROM llm_slots WHERE acquired_at < ?", (now - LLM_SLOT_LEASE_SEC,))
+            (inflight,) = db.execute("SELECT COUNT(*) FROM llm_slots").fetchone()
+            if inflight < LLM_MAX_INFLIGHT:
+                db.execute("INSERT INTO llm_slots (token, acquired_at) VALUES (?, ?)", (token, now))
+                return token
+        if now >= deadline:
+            return None
+        time.sleep(0.05)
+
+
+def release_llm_slot(token: str):
+    get_db().execute("DELETE FROM llm_slots WHERE token = ?", (token,))
+
+
+def breaker_state():
+    row = get_db().execute(
+        "SELECT state, failures, changed_at FROM breaker WHERE name = 'gemini'"
+    ).fetchone()
+    return row or ("closed", 0, 0.0)
+
+
+def breaker_allow() -> bool:
+    now = time.time()
+    with db_transaction() as db:
+        row = db.execute(
+            "SELECT state, changed_at FROM breaker WHERE name = 'gemini'"
+        ).fetchone()
+        if row is None or row[0] == "closed":
+            return True
+        # Setelah cooldown, satu panggilan percobaan (half-open) diizinkan
+        if now - row[1] < BREAKER_COOLDOWN_SEC:
+            return False
+        db.execute(
+            "UPDATE breaker SET state = 'half_open', changed_at = ? WHERE name = 'gemini'",
+            (now,),
+        )
+        return True
+
+
+def breaker_record(ok: bool):
+    now = time.time()
+    with db_transaction() as db:
+        state, failures, _ = db.execute(
+            "SELECT state, failures, changed_at FROM breaker WHERE name = 'gemini'"
+        ).fetchone() or ("closed", 0, 0.0)
+        if ok:
+            state, failures = "closed", 0
+        else:
+            failures += 1
+            if state == "half_open" or failures >= BREAKER_FAILURES:
+                if state != "open":
+                    logging.warning(f"🔌 Circuit breaker Gemini terbuka ({failures} kegagalan)")
+                state = "open"
+        db.execute(
+            "INSERT OR REPLACE INTO breaker (name, state, failures, changed_at) "
+            "VALUES ('gemini', ?, ?, ?)",
+            (state, failures, now),
+        )
+
+
+@contextmanager
+def llm_guard():
+    """Izinkan satu panggilan Gemini; LlmUnavailable jika breaker terbuka atau slot penuh."""
+    if not breaker_allow():
+        incr_counter("admission:breaker_open")
+        raise LlmUnavailable("circuit breaker terbuka")
+
+    token = acquire_llm_slot()
+    if token is None:
+        incr_counter("admission:no_slot")
+        raise LlmUnavailable("slot Gemini penuh")
+
+    call = {"latency": None}
+    start = time.perf_counter()
+    try:
+        yield call
+    except Exception:
+        breaker_record(False)
+        raise
+    else:
+        latency = call["latency"] if call["latency"] is not None else time.perf_counter() - start
+        breaker_record(latency <= LLM_SLO_SEC)
+    finally:
+        release_llm_slot(token)
+
+
+def degraded_reply(user_message: str) -> str:
+    # Gemini tidak tersedia: pakai FAQ dengan ambang lebih longgar, jika tidak ada pakai fallback
+    answer, confidence = faq_index.search(user_message)
+    if answer is not None and confidence >= BREAKER_FAQ_MIN_CONFIDENCE:
+        return answer
+    return FALLBACK_REPLY
+
+
+def admission_stats() -> dict:
+    state, failures, changed_at = breaker_state()
+    (inflight,) = get_db().execute("SELECT COUNT(*) FROM llm_slots").fetchone()
+    return {
+        "breaker": {
+            "state": state,
+            "consecutive_failures": failures,
+            "changed_at": changed_at,
+            "failure_threshold": BREAKER_FAILURES,
+            "cooldown_sec": BREAKER_COOLDOWN_SEC,
+            "slo_sec": LLM_SLO_SEC,
+        },
+        "limiter": {
+            "sender_rate_per_min": SENDER_RATE_PER_MIN,
+            "sender_burst": SENDER_BURST,
+            "llm_max_inflight": LLM_MAX_INFLIGHT,
+            "llm_inflight": inflight,
+            "llm_slot_wait_sec": LLM_SLOT_WAIT_SEC,
+        },
+        "rejections": read_counters("admission:"),
+    }
+
+# ------------------------------------------------------------
+# 📈 METRIK & LOG PERCAKAPAN
+# ------------------------------------------------------------
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Metrics:
+    """Histogram latensi per tahap, error per tahap, dan gauge in-flight milik satu proses."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {}
+        self.errors = Counter()
+        self.gauges = Counter()
+        self.requests = Counter()
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            hist = self.stages.setdefault(stage, {"buckets": [0] * len(STAGE_BUCKETS), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(STAGE_BUCKETS):
+                if seconds <= bound:
+                    hist["buckets"][i] += 1
+            hist["sum"] += seconds
+            hist["count"] += 1
+
+    def error(self, stage: str):
+        with self._lock:
+            self.errors[stage] += 1
+
+    def gauge_add(self, name: str, delta: int):
+        with self._lock:
+            self.gauges[name] += delta
+
+    def count_request(self, path: str, status: int):
+        with self._lock:
+            self.requests[f"{path} {status}"] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return json.loads(json.dumps({
+                "stages": self.stages,
+                "errors": self.errors,
+                "gauges": self.gauges,
+                "requests": self.requests,
+            }))
+
+
+metrics = Metrics()
+_metrics_worker_id = f"{os.getpid()}-{int(time.time())}"
+
+
+@contextmanager
+def track_stage(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        metrics.error(stage)
+        raise
+    finally:
+        metrics.observe(stage, time.perf_counter() - start)
+
+
+def flush_metrics():
+    now = time.time()
+    db = get_db()
+    db.execute(
+        "INSERT OR REPLACE INTO metrics_snapshots (worker, data, updated_at) VALUES (?, ?, ?)",
+        (_metrics_worker_id, json.dumps(metrics.snapshot()), now),
+    )
+    db.execute("DELETE FROM metrics_snapshots WHERE updated_at < ?", (now - 86400,))
+
+
+def _metrics_flusher():
+    while True:
+        time.sleep(METRICS_FLUSH_SEC)
+        try:
+            flush_metrics()
+        except sqlite3.Error:
+            logging.exception("⚠️ Gagal menyimpan snapshot metrik:")
+
+
+def _prom_labels(**labels) -> str:
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+
+def render_metrics() -> str:
+    flush_metrics()
+    now = time.time()
+    rows = get_db().execute("SELECT data, updated_at FROM metrics_snapshots").fetchall()
+
+    stages, errors, gauges, requests_total = {}, Counter(), Counter(), Counter()
+    for data, updated_at in rows:
+        snap = json.loads(data)
+        for stage, hist in snap["stages"].items():
+            agg = stages.setdefault(stage, {"buckets": [0] * len(STAGE_BUCKETS), "sum": 0.0, "count": 0})
+            agg["buckets"] = [a + b for a, b in zip(agg["buckets"], hist["buckets"])]
+            agg["sum"] += hist["sum"]
+            agg["count"] += hist["count"]
+        errors.update(snap["errors"])
+        requests_total.update(snap["requests"])
+        # Gauge hanya dari worker yang masih hidup
+        if now - updated_at <= METRICS_FLUSH_SEC * 3:
+            gauges.update(snap["gauges"])
+
+    lines = [
+        "# HELP aira_stage_duration_seconds Latensi per tahap pemrosesan pesan.",
+        "# TYPE aira_stage_duration_seconds histogram",
+    ]
+    for stage, hist in sorted(stages.items()):
+        for bound, count in zip(STAGE_BUCKETS, hist["buckets"]):
+            lines.append(f"aira_stage_duration_seconds_bucket{_prom_labels(stage=stage, le=bound)} {count}")
+        lines.append(f"aira_stage_duration_seconds_bucket{_prom_labels(stage=stage, le='+Inf')} {hist['count']}")
+        lines.append(f"aira_stage_duration_seconds_sum{_prom_labels(stage=stage)} {hist['sum']:.6f}")
+        lines.append(f"aira_stage_duration_seconds_count{_prom_labels(stage=stage)} {hist['count']}")
+
+    lines += ["# HELP aira_stage_errors_total Error per tahap.", "# TYPE aira_stage_errors_total counter"]
+    for stage, count in sorted(errors.items()):
+        lines.append(f"aira_stage_errors_total{_prom_labels(stage=stage)} {count}")
+
+    lines += ["# HELP aira_in_flight Request/job yang sedang diproses.", "# TYPE aira_in_flight gauge"]
+    for name in ("requests", "jobs"):
+        lines.append(f"aira_in_flight{_prom_labels(kind=name)} {gauges.get(name, 0)}")
+
+    lines += ["# HELP aira_http_requests_total Request HTTP per path & status.", "# TYPE aira_http_requests_total counter"]
+    for key, count in sorted(requests_total.items()):
+        path, code = key.rsplit(" ", 1)
+        lines.append(f"aira_http_requests_total{_prom_labels(path=path, status=code)} {count}")
+
+    lines += ["# HELP aira_events_total Counter bersama (cache, router, dedup, admission, total riwayat).", "# TYPE aira_events_total counter"]
+    for name, value in get_db().execute("SELECT name, value FROM counters ORDER BY name"):
+        lines.append(f"aira_events_total{_prom_labels(name=name)} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+def send_failed(result) -> bool:
+    return not isinstance(result, dict) or result.get("sent") is False or result.get("status") is False
+
+
+def log_conversation(sender: str, message: str, reply: str, route: str, result):
+    status = "FAILED" if send_failed(result) else "SENT"
+    conv_logger.info(json.dumps(
+        {"ts": round(time.time(), 3), "type": "CONV", "sender": sender, "msg": message,
+         "reply": reply, "route": route, "status": status},
+        ensure_ascii=False, separators=(",", ":"),
+    ))
+
+
+threading.Thread(target=_metrics_flusher, name="aira-metrics", daemon=True).start()
+atexit.register(flush_metrics)
+
+# ------------------------------------------------------------
+# 💬 PROSES PESAN
+# ------------------------------------------------------------
+def route_user_message(message: str):
+    """Kembalikan (pesan untuk AI, route, balasan lokal atau None)."""
+    with track_stage("routing"):
+        message_lower = message.lower().strip()
+
+        user_message = message
+        if TRIGGER in message_lower:
+            user_message = message_lower.replace(TRIGGER, "").strip()
+
+        route, reply = route_message(user_message)
+        incr_counter(f"route:{route}")
+    return user_message, route, reply
+
+
+def process_message(sender: str, message: str):
+    started = time.perf_counter()
+    user_message, route, ai_reply = route_user_message(message)
+
+    if ai_reply is None and STREAM_MODE:
+        ai_reply, result = stream_ai_response(sender, user_message, started)
+    else:
+        if ai_reply is None:
+            ai_reply = get_ai_response(user_message, sender)
+        result = send_message_to_fonnte(sender, ai_reply)
+        # Hanya route Gemini yang dibandingkan dengan first_send_stream
+        if route == "llm":
+            record_latency("first_send_buffered", time.perf_counter() - started)
+    # Satu record CONV per pesan, dengan pesan asli, di mode stream maupun biasa
+    log_conversation(sender, message, ai_reply, route, result)
+    return result
+
+# ------------------------------------------------------------
+# 📬 ANTREAN JOB & WORKER
+# ------------------------------------------------------------
+_queue_stop = threading.Event()
+_queue_wake = threading.Event()
+_queue_threads = []
+
+
+def enqueue_job(sender: str, message: str) -> bool:
+    if _queue_stop.is_set():
+        incr_counter("admission:draining")
+        return False
+
+    now = time.time()
+    with db_transaction() as db:
+        # Pesan beruntun digabung ke job pengirim yang belum diambil worker
+        if DEBOUNCE_SEC > 0:
+            row = db.execute(
+                "SELECT id, created_at FROM jobs WHERE sender = ? AND status = 'pending' "
+                "ORDER BY id DESC LIMIT 1",
+                (sender,),
+            ).fetchone()
+            if row is not None:
+                available_at = min(now + DEBOUNCE_SEC, row[1] + DEBOUNCE_MAX_WAIT_SEC)
+                db.execute(
+                    "UPDATE jobs SET message = message || char(10) || ?, available_at = ? "
+                    "WHERE id = ?",
+                    (message, available_at, row[0]),
+                )
+                incr_counter("dedup:merged")
+                return True
+
+        (depth,) = db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = 'pending'"
+        ).fetchone()
+        if depth >= QUEUE_MAX_SIZE:
+            incr_counter("admission:queue_full")
+            return False
+        db.execute(
+            "INSERT INTO jobs (sender, message, created_at, available_at) VALUES (?, ?, ?, ?)",
+            (sender, message, now, now + DEBOUNCE_SEC),
+        )
+
+    _queue_wake.set()
+    return True
+
+
+def claim_job():
+    # Job 'processing' yang lease-nya habis (worker mati) diambil ulang
+    now = time.time()
+    with db_transaction() as db:
+        row = db.execute(
+            "SELECT id, sender, message, created_at, attempts FROM jobs "
+            "WHERE (status = 'pending' AND available_at <= ?) "
+            "OR (status = 'processing' AND started_at < ?) "
+            "ORDER BY id LIMIT 1",
+            (now, now - QUEUE_LEASE_SEC),
+        ).fetchone()
+        if row is None:
+            return None
+        db.execute(
+            "UPDATE jobs SET status = 'processing', started_at = ?, attempts = attempts + 1 "
+            "WHERE id = ?",
+            (now, row[0]),
+        )
+    return (*row, now)
+
+
+def run_job(job):
+    # started_at menandai lease milik worker ini; jika lease sudah diambil worker lain, job tidak disentuh
+    job_id, sender, message, created_at, attempts, started_at = job
+    logging.info(f"⏱️ Job #{job_id} diproses (umur {time.time() - created_at:.2f}s)")
+
+    metrics.gauge_add("jobs", 1)
+    try:
+        process_message(sender, message)
+    except Exception:
+        logging.exception(f"💥 Job #{job_id} gagal:")
+        with db_transaction() as db:
+            if attempts + 1 >= QUEUE_MAX_ATTEMPTS:
+                logging.error(f"🗑️ Job #{job_id} dibuang setelah {attempts + 1} percobaan")
+                db.execute(
+                    "DELETE FROM jobs WHERE id = ? AND started_at = ?", (job_id, started_at)
+                )
+            else:
+                db.execute(
+                    "UPDATE jobs SET status = 'pending' WHERE id = ? AND started_at = ?",
+                    (job_id, started_at),
+                )
+        return
+    finally:
+        metrics.gauge_add("jobs", -1)
+
+    get_db().execute("DELETE FROM jobs WHERE id = ? AND started_at = ?", (job_id, started_at))
+
+
+def _queue_worker():
+    # Saat shutdown, job yang sedang berjalan diselesaikan tapi job baru tidak diambil lagi;
+    # sisa antrean dikerjakan worker lain atau proses berikutnya
+    while not _queue_stop.is_set():
+        try:
+            job = claim_job()
+        except sqlite3.Error:
+            logging.exception("⚠️ Gagal mengambil job dari antrean:")
+            job = None
+
+        if job is None:
+            _queue_wake.wait(QUEUE_POLL_SEC)
+            _queue_wake.clear()
+            continue
+
+        run_job(job)
+
+
+def queue_stats() -> dict:
+    db = get_db()
+    rows = db.execute(
+        "SELECT status, COUNT(*), MIN(created_at) FROM jobs GROUP BY status"
+    ).fetchall()
+    now = time.time()
+    stats = {"pending": 0, "processing": 0, "oldest_age_sec": 0.0}
+    for status, count, oldest in rows:
+        stats[status] = count
+        stats["oldest_age_sec"] = max(stats["oldest_age_sec"], round(now - oldest, 3))
+    stats["max_size"] = QUEUE_MAX_SIZE
+    stats["workers_alive"] = sum(t.is_alive() for t in _queue_threads)
+    return stats
+
+
+def start_queue_workers():
+    for i in range(QUEUE_WORKERS):
+        t = threading.Thread(target=_queue_worker, name=f"aira-worker-{i}", daemon=True)
+        t.start()
+        _queue_threads.append(t)
+    atexit.register(drain_queue_workers)
+    logging.info(f"🧵 {QUEUE_WORKERS} worker antrean aktif (pid {os.getpid()})")
+
+
+def drain_queue_workers():
+    # Berhenti terima & ambil job baru, tunggu job yang sedang jalan; sisanya tetap aman di SQLite
+    _queue_stop.set()
+    _queue_wake.set()
+    deadline = time.time() + QUEUE_DRAIN_TIMEOUT
+    for t in _queue_threads:
+        t.join(max(0.0, deadline - time.time()))
+    logging.info(f"🛑 Worker antrean berhenti, sisa antrean: {queue_stats()}")
+
+
+if ASYNC_MODE:
+    start_queue_workers()
+elif DEBOUNCE_SEC > 0:
+    logging.warning("⚠️ DEBOUNCE_SEC hanya berlaku bila ASYNC_MODE=1, pesan tidak digabung")
 
 # ------------------------------------------------------------
 # 🌐 WEBHOOK
@@ -103,44 +1601,92 @@ def webhook():
     if request.method == "GET":
         return jsonify({"ok": True, "message": "Webhook aktif."})
 
+    # Payload yang sudah dicatat dedup tapi tidak selesai diterima harus dilepas lagi
+    seen = None
     try:
-        payload = request.get_json(force=True)
-        logging.info(f"📩 Pesan Masuk: {payload}")
+        with track_stage("parse"):
+            payload = request.get_json(force=True)
+            logging.debug(f"📩 Pesan Masuk: {payload}")
 
-        sender = payload.get("sender") or payload.get("from")
-        message = payload.get("message") or payload.get("text")
-        is_group = payload.get("isgroup", False)
+            sender = payload.get("sender") or payload.get("from")
+            message = payload.get("message") or payload.get("text")
+            is_group = payload.get("isgroup", False)
 
         if not sender or not message:
             return jsonify({"ok": False, "error": "Payload tidak valid"}), 400
 
-        message_lower = message.lower().strip()
-        sapaan = ["halo", "hai", "hallo", "pagi", "siang", "malam"]
+        message_id = payload.get("id") or payload.get("inboxid")
+        if not mark_seen(sender, message, message_id):
+            logging.info(f"♻️ Payload duplikat dari {sender} diabaikan")
+            return jsonify({"ok": True, "duplicate": True}), 200
+        seen = (sender, message, message_id)
 
-        trigger = "@aigizi"
+        conv_logger.info(json.dumps(
+            {"ts": round(time.time(), 3), "type": "INCOMING", "sender": sender, "msg": message},
+            ensure_ascii=False, separators=(",", ":"),
+        ))
 
-        if trigger in message_lower:
-            user_message = message_lower.replace(trigger, "").strip()
-            ai_reply = get_ai_response(user_message)
+        if not allow_sender(sender):
+            logging.warning(f"🚦 Rate limit: pesan dari {sender} ditolak")
+            forget_seen(*seen)
+            return jsonify({"ok": False, "error": "Terlalu banyak pesan"}), 429
 
-        elif any(word in message_lower for word in sapaan):
-            ai_reply = (
-                "👋 Hai! Aku *Aira Nutria*, asisten edukasi gizi anak.\n"
-                "Silakan tanya apa yang ingin kamu ketahui tentang nutrisi & pola makan sehat untuk anak 😊"
-            )
-
-        else:
-            ai_reply = get_ai_response(message)
+        if ASYNC_MODE:
+            if not enqueue_job(sender, message):
+                logging.warning(f"🚧 Antrean penuh/berhenti, pesan dari {sender} ditolak")
+                forget_seen(*seen)
+                return jsonify({"ok": False, "error": "Antrean penuh"}), 429
+            return jsonify({"ok": True, "queued": True}), 200
 
-        target = sender
-        send_message_to_fonnte(target, ai_reply)
+        process_message(sender, message)
 
         return jsonify({"ok": True, "sent": True}), 200
 
     except Exception as e:
         logging.exception("💥 Error di webhook:")
+        if seen:
+            forget_seen(*seen)
         return jsonify({"ok": False, "error": str(e)}), 500
 
+@app.before_request
+def _track_in_flight():
+    metrics.gauge_add("requests", 1)
+
+
+@app.after_request
+def _count_request(response):
+    metrics.count_request(request.path, response.status_code)
+    return response
+
+
+@app.teardown_request
+def _untrack_in_flight(exc):
+    metrics.gauge_add("requests", -1)
+
+# ------------------------------------------------------------
+# 📊 STATUS
+# ------------------------------------------------------------
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/status", methods=["GET"])
+def status():
+    return jsonify({
+        "ok": True,
+        "async_mode": ASYNC_MODE,
+        "queue": queue_stats(),
+        "cache": cache_stats(),
+        "sender": fonnte_sender.stats(),
+        "router": router_stats(),
+        "history": history_stats(),
+        "dedup": dedup_stats(),
+        "admission": admission_stats(),
+        "stream_mode": STREAM_MODE,
+        "latency": latency_stats(),
+    })
+
 # ------------------------------------------------------------
 # 🚀 RUN SERVER
 # ------------------------------------------------------------
@@ -0,0 +1,371 @@
+# ============================================================
+# 📊 Benchmark & Load Test – Aira Gizi Anak (offline)
+# ============================================================
+# Menjalankan app.py di bawah gunicorn dengan backend stub (tanpa Gemini/Fonnte
+# sungguhan), memutar ulang pesan INCOMING dari log atau trafik sintetis pada
+# RPS tertentu, lalu melaporkan throughput, p50/p95/p99, error rate, laju kirim
+# Fonnte, dan porsi rute (faq/llm/...) per konfigurasi.
+#
+# Contoh:
+#   python benchmark.py --replay chatbot.log --rps 20 --duration 15 \
+#       --workers 1,2 --worker-class sync,gthread --max-p99-ms 3000
+import argparse
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from stub_backends import sample_latency
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SYNTHETIC_MESSAGES = [
+    "Halo",
+    "Anak susah makan, tips?",
+    "MPASI 6 bulan",
+    "alergi susu sapi",
+    "kapan mulai mpasi?",
+    "@aigizi anak 2 tahun butuh berapa gelas susu sehari?",
+    "Anak saya 8 bulan belum mau makan makanan bertekstur, gimana ya?",
+    "siapa namamu?",
+    "Bagaimana cara menambah berat badan anak 3 tahun?",
+    "Apakah anak boleh makan mie instan?",
+]
+
+# ------------------------------------------------------------
+# 📥 SUMBER TRAFIK
+# ------------------------------------------------------------
+def parse_incoming(line: str):
+    """Ambil (sender, pesan) dari baris JSONL atau baris INCOMING chatbot.log."""
+    line = line.strip()
+    if not line:
+        return None
+
+    if line.startswith("{"):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            return None
+        if record.get("type", "INCOMING") != "INCOMING":
+            return None
+        message = record.get("message") or record.get("msg") or record.get("text")
+        sender = record.get("sender") or record.get("from") or "6281200000000"
+        return (str(sender), message) if isinstance(message, str) and message else None
+
+    fields = line.split("\t")
+    if "INCOMING" not in fields:
+        return None
+    values = dict(f.split("=", 1) for f in fields[fields.index("INCOMING") + 1:] if "=" in f)
+    if not values.get("msg"):
+        return None
+    return values.get("sender", "6281200000000"), values["msg"]
+
+
+def load_replay(paths):
+    messages = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            messages.extend(m for m in map(parse_incoming, f) if m)
+    return messages
+
+
+def synthetic_traffic(senders: int):
+    return [
+        (f"62812{i:08d}", random.choice(SYNTHETIC_MESSAGES))
+        for i in random.sample(range(senders * 10), senders)
+    ]
+
+# ------------------------------------------------------------
+# 🧪 STUB FONNTE LOKAL (HTTP)
+# ------------------------------------------------------------
+def start_fonnte_stub(latency_ms: float, dist: str, error_rate: float):
+    """Stub HTTP Fonnte; setiap kiriman dicatat di server.hits sebagai (selesai, latensi, kode)."""
+    hits = []
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            start = time.perf_counter()
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            time.sleep(sample_latency(latency_ms, dist))
+            code = 500 if random.random() < error_rate else 200
+            body = json.dumps({"status": code == 200}).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            end = time.perf_counter()
+            with lock:
+                hits.append((end, end - start, code))
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    server.hits = hits
+    server.hits_lock = lock
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# ------------------------------------------------------------
+# 🚀 GUNICORN
+# ------------------------------------------------------------
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_app(workers: int, worker_class: str, threads: int, env: dict, workdir: str):
+    port = free_port()
+    cmd = [
+        sys.executable, "-m", "gunicorn",
+        "-w", str(workers), "-k", worker_class, "--threads", str(threads),
+        "-b", f"127.0.0.1:{port}", "--pythonpath", REPO_DIR,
+        "--log-level", "warning", "app:app",
+    ]
+    log = open(os.path.join(workdir, "gunicorn.log"), "ab")
+    proc = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    url = f"http://127.0.0.1:{port}/webhook"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"gunicorn berhenti, cek {workdir}/gunicorn.log")
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return proc, url
+        except requests.RequestException:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("gunicorn tidak siap dalam 30 detik")
+
+
+def fetch_status(url: str) -> dict:
+    try:
+        return requests.get(url.replace("/webhook", "/status"), timeout=5).json()
+    except (requests.RequestException, ValueError):
+        return {}
+
+
+def stop_app(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+# ------------------------------------------------------------
+# 📈 LOAD GENERATOR
+# ------------------------------------------------------------
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def run_load(url: str, traffic, rps: float, duration: float, concurrency: int, timeout: float):
+    """Open-loop: request ke-i dijadwalkan pada i/rps detik, tidak menunggu balasan sebelumnya."""
+    total = max(1, int(rps * duration))
+    local = threading.local()
+    results = []
+    lock = threading.Lock()
+
+    def fire(i: int, due: float):
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+
+        sender, message = traffic[i % len(traffic)]
+        # id unik supaya dedup tidak menganggap replay sebagai kiriman ulang Fonnte
+        payload = {"sender": sender, "message": message, "id": f"bench-{i}"}
+        start = time.perf_counter()
+        try:
+            status = session.post(url, json=payload, timeout=timeout).status_code
+        except requests.RequestException:
+            status = 0
+        with lock:
+            results.append((time.perf_counter() - start, status))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for i in range(total):
+            pool.submit(fire, i, started + i / rps)
+    elapsed = time.perf_counter() - started
+
+    latencies = [lat for lat, _ in results]
+    errors = sum(1 for _, status in results if status != 200)
+    return {
+        "requests": len(results),
+        "elapsed_sec": round(elapsed, 2),
+        "throughput_rps": round(len(results) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "error_rate": round(errors / len(results), 4) if results else 0.0,
+        "status_codes": {str(c): sum(1 for _, s in results if s == c) for c in sorted({s for _, s in results})},
+    }
+
+
+def sender_report(hits, started: float) -> dict:
+    """Laju & latensi kirim dari sisi stub Fonnte, jadi mencakup semua worker gunicorn."""
+    sent = [lat for _, lat, code in hits if code == 200]
+    elapsed = max((end for end, _, _ in hits), default=started) - started
+    return {
+        "fonnte_sends": len(sent),
+        "fonnte_failed": len(hits) - len(sent),
+        "sends_per_sec": round(len(sent) / elapsed, 2) if elapsed > 0 else 0.0,
+        "send_p50_ms": round(percentile(sent, 0.50) * 1000, 1),
+        "send_p99_ms": round(percentile(sent, 0.99) * 1000, 1),
+    }
+
+
+def route_share(routes: dict, route: str) -> float:
+    total = sum(routes.values())
+    return round(routes.get(route, 0) / total, 4) if total else 0.0
+
+# ------------------------------------------------------------
+# 🏁 MAIN
+# ------------------------------------------------------------
+def bench_env(args, workdir: str, fonnte_url: str) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "LLM_BACKEND": "stub",
+        "STUB_LLM_LATENCY_MS": str(args.llm_latency_ms),
+        "STUB_LLM_LATENCY_DIST": args.latency_dist,
+        "STUB_LLM_ERROR_RATE": str(args.llm_error_rate),
+        "FONNTE_BACKEND": args.fonnte_backend,
+        "STUB_FONNTE_LATENCY_MS": str(args.fonnte_latency_ms),
+        "STUB_FONNTE_LATENCY_DIST": args.latency_dist,
+        "STUB_FONNTE_ERROR_RATE": str(args.fonnte_error_rate),
+        "FONNTE_SEND_URL": fonnte_url,
+        "FONNTE_TOKEN": "bench",
+        "FONNTE_RATE_PER_SEC": "0",
+        "FONNTE_BACKOFF_SEC": "0.05",
+        "SENDER_RATE_PER_MIN": "0",
+        "AIRA_DB_PATH": os.path.join(workdir, "aira.db"),
+        "CONV_LOG_PATH": os.path.join(workdir, "conversations.jsonl"),
+        "FONNTE_DEADLETTER_PATH": os.path.join(workdir, "fonnte-deadletter.jsonl"),
+    })
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    return env
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark offline webhook Aira di bawah gunicorn.")
+    parser.add_argument("--replay", action="append", default=[], help="File JSONL/chatbot.log berisi INCOMING (boleh berulang)")
+    parser.add_argument("--senders", type=int, default=50, help="Jumlah pengirim untuk trafik sintetis")
+    parser.add_argument("--seed", type=int, help="Seed acak supaya trafik sintetis & latensi stub bisa diulang")
+    parser.add_argument("--rps", type=float, default=20)
+    parser.add_argument("--duration", type=float, default=15)
+    parser.add_argument("--concurrency", type=int, default=64, help="Batas request klien bersamaan")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--workers", default="2", help="Daftar jumlah worker, mis. 1,2,4")
+    parser.add_argument("--worker-class", default="sync", help="Daftar kelas worker, mis. sync,gthread")
+    parser.add_argument("--threads", type=int, default=4, help="Thread per worker untuk gthread")
+    parser.add_argument("--llm-latency-ms", type=float, default=800)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--fonnte-backend", choices=["stub", "http"], default="http",
+                        help="stub = in-process, http = stub HTTP lokal lewat FonnteSender")
+    parser.add_argument("--fonnte-latency-ms", type=float, default=150)
+    parser.add_argument("--fonnte-error-rate", type=float, default=0.0)
+    parser.add_argument("--latency-dist", choices=["fixed", "uniform", "exp", "lognormal"], default="lognormal")
+    parser.add_argument("--env", action="append", default=[], help="Variabel tambahan untuk app, KEY=VALUE")
+    parser.add_argument("--json", help="Simpan hasil ke file JSON")
+    parser.add_argument("--max-p99-ms", type=float, help="Gagal (exit 1) jika p99 melebihi nilai ini")
+    parser.add_argument("--max-error-rate", type=float, help="Gagal (exit 1) jika error rate melebihi nilai ini")
+    parser.add_argument("--min-llm-share", type=float,
+                        help="Gagal (exit 1) jika porsi pesan yang dijawab lewat Gemini di bawah nilai ini")
+    args = parser.parse_args(argv)
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    traffic = load_replay(args.replay) if args.replay else synthetic_traffic(args.senders)
+    if not traffic:
+        print("❌ Tidak ada pesan INCOMING untuk diputar ulang")
+        return 2
+
+    fonnte = start_fonnte_stub(args.fonnte_latency_ms, args.latency_dist, args.fonnte_error_rate)
+    fonnte_url = f"http://127.0.0.1:{fonnte.server_port}/send"
+
+    reports = []
+    configs = itertools.product(
+        [int(w) for w in args.workers.split(",")],
+        args.worker_class.split(","),
+    )
+    for workers, worker_class in configs:
+        with tempfile.TemporaryDirectory(prefix="aira-bench-") as workdir:
+            proc, url = start_app(workers, worker_class, args.threads,
+                                  bench_env(args, workdir, fonnte_url), workdir)
+            with fonnte.hits_lock:
+                fonnte.hits.clear()
+            started = time.perf_counter()
+            try:
+                result = run_load(url, traffic, args.rps, args.duration, args.concurrency, args.timeout)
+                routes = fetch_status(url).get("router", {}).get("hits", {})
+            finally:
+                stop_app(proc)
+            with fonnte.hits_lock:
+                hits = list(fonnte.hits)
+
+        threads = args.threads if worker_class == "gthread" else 1
+        result.update({"workers": workers, "worker_class": worker_class, "threads": threads})
+        # Dengan --fonnte-backend stub kiriman tidak lewat HTTP, jadi hanya tersedia di /status tiap worker
+        if args.fonnte_backend == "http":
+            result.update(sender_report(hits, started))
+        result.update({"routes": routes, "llm_share": route_share(routes, "llm")})
+        reports.append(result)
+        print(
+            f"📊 w={workers} k={worker_class} t={threads}: "
+            f"{result['throughput_rps']} rps, p50={result['p50_ms']}ms "
+            f"p95={result['p95_ms']}ms p99={result['p99_ms']}ms "
+            f"error={result['error_rate']:.2%} {result['status_codes']}"
+        )
+        if "fonnte_sends" in result:
+            print(
+                f"   📤 Fonnte: {result['fonnte_sends']} terkirim ({result['sends_per_sec']}/detik), "
+                f"p99={result['send_p99_ms']}ms, gagal={result['fonnte_failed']}"
+            )
+        print(f"   🧭 Rute: {routes} (llm={result['llm_share']:.0%})")
+
+    fonnte.shutdown()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"rps": args.rps, "duration": args.duration, "results": reports}, f, indent=2)
+
+    failed = False
+    for r in reports:
+        if args.max_p99_ms is not None and r["p99_ms"] > args.max_p99_ms:
+            print(f"❌ p99 {r['p99_ms']}ms > {args.max_p99_ms}ms (w={r['workers']} k={r['worker_class']})")
+            failed = True
+        if args.max_error_rate is not None and r["error_rate"] > args.max_error_rate:
+            print(f"❌ error rate {r['error_rate']:.2%} > {args.max_error_rate:.2%} (w={r['workers']} k={r['worker_class']})")
+            failed = True
+        if args.min_llm_share is not None and r["llm_share"] < args.min_llm_share:
+            print(f"❌ porsi llm {r['llm_share']:.2%} < {args.min_llm_share:.2%} (w={r['workers']} k={r['worker_class']})")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
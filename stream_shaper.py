@@ -0,0 +1,79 @@
+# ============================================================
+# 🌊 Perapi stream Gemini → potongan pesan WhatsApp
+# ============================================================
+import re
+
+_WORD_RE = re.compile(r"\S+")
+# Titik potong: akhir kalimat (bukan "1." pada daftar) atau pergantian baris/bullet
+_BOUNDARY_RE = re.compile(r"(?<!\d)[.!?…](?=\s)|\n")
+
+
+def clean_reply(text: str) -> str:
+    return text.replace("**", "").replace("--", "")
+
+
+class StreamShaper:
+    """Merapikan potongan stream secara bertahap dan memecahnya jadi pesan WhatsApp."""
+
+    def __init__(self, max_words: int, min_chars: int, max_chars: int):
+        self.max_words = max_words
+        self.min_chars = min_chars
+        self.max_chars = max(max_chars, min_chars + 1)
+        self.text = ""
+        self.done = False
+        self._tail = ""
+        self._emitted = 0
+
+    def feed(self, raw: str):
+        if self.done:
+            return []
+
+        # Tahan '*' / '-' di ujung supaya "**" atau "--" yang terbelah tetap terhapus
+        raw = self._tail + raw
+        cut = len(raw)
+        while cut and raw[cut - 1] in "*-":
+            cut -= 1
+        self._tail = raw[cut:]
+        self.text += clean_reply(raw[:cut])
+        self._apply_budget()
+        return self._take_pieces(final=self.done)
+
+    def finish(self):
+        if not self.done:
+            self.text += clean_reply(self._tail)
+            self._tail = ""
+            self._apply_budget()
+            self.done = True
+        return self._take_pieces(final=True)
+
+    def _apply_budget(self):
+        words = list(_WORD_RE.finditer(self.text))
+        if len(words) > self.max_words:
+            self.text = self.text[:words[self.max_words - 1].end()] + "..."
+            self.done = True
+
+    def _take_pieces(self, final: bool):
+        # Mode final tetap memotong per max_chars, hanya sisa terakhir boleh lebih pendek dari min_chars
+        pieces = []
+        while True:
+            rest = self.text[self._emitted:]
+            if len(rest) <= (self.max_chars if final else self.min_chars):
+                if final:
+                    if rest.strip():
+                        pieces.append(rest.strip())
+                    self._emitted = len(self.text)
+                return pieces
+
+            window = rest[:self.max_chars]
+            cut = 0
+            for m in _BOUNDARY_RE.finditer(window):
+                if m.end() >= self.min_chars:
+                    cut = m.end()
+            if not cut:
+                if len(rest) < self.max_chars:
+                    return pieces
+                cut = window.rfind(" ", self.min_chars) + 1 or len(window)
+
+            if rest[:cut].strip():
+                pieces.append(rest[:cut].strip())
+            self._emitted += cut
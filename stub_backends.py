@@ -0,0 +1,94 @@
+# ============================================================
+# 🧪 Backend stub Gemini & Fonnte – untuk benchmark offline
+# ============================================================
+import random
+import threading
+import time
+
+STUB_REPLY = (
+    "Halo Bunda 😊 Untuk anak yang susah makan, coba buat jadwal makan teratur "
+    "dan batasi waktu makan sekitar 30 menit.\n"
+    "• Beri porsi kecil dulu, tambah jika anak masih mau.\n"
+    "• Hindari camilan dan susu 1–2 jam sebelum makan.\n"
+    "• Sajikan makanan dengan warna dan bentuk yang menarik.\n"
+    "Jika berat badan tidak naik, periksakan ke dokter anak ya 🙏"
+)
+
+
+def sample_latency(mean_ms: float, dist: str = "fixed") -> float:
+    """Latensi acak (detik) dengan rata-rata mean_ms: fixed, uniform, exp, lognormal."""
+    if mean_ms <= 0:
+        return 0.0
+    if dist == "uniform":
+        ms = random.uniform(0, 2 * mean_ms)
+    elif dist == "exp":
+        ms = random.expovariate(1 / mean_ms)
+    elif dist == "lognormal":
+        # sigma 0.5 → ekor panjang seperti API sungguhan, rata-rata tetap mean_ms
+        ms = random.lognormvariate(0, 0.5) * mean_ms / 1.1331
+    else:
+        ms = mean_ms
+    return ms / 1000
+
+
+class _StubResponse:
+    def __init__(self, text: str, prompt_tokens: int):
+        self.text = text
+        self.usage_metadata = type("Usage", (), {"prompt_token_count": prompt_tokens})()
+
+
+class StubModel:
+    """Pengganti GenerativeModel: latensi & error bisa diatur, tidak ada panggilan jaringan."""
+
+    def __init__(self, latency_ms: float = 800, dist: str = "fixed", error_rate: float = 0.0,
+                 text: str = STUB_REPLY, chunks: int = 4):
+        self.latency_ms = latency_ms
+        self.dist = dist
+        self.error_rate = error_rate
+        self.text = text
+        self.chunks = max(1, chunks)
+
+    def generate_content(self, contents, generation_config=None, stream=False):
+        prompt_tokens = len(str(contents)) // 4 + 1
+        latency = sample_latency(self.latency_ms, self.dist)
+        if random.random() < self.error_rate:
+            time.sleep(latency)
+            raise RuntimeError("stub Gemini error")
+        if not stream:
+            time.sleep(latency)
+            return _StubResponse(self.text, prompt_tokens)
+        return self._stream(latency, prompt_tokens)
+
+    def _stream(self, latency: float, prompt_tokens: int):
+        size = len(self.text) // self.chunks + 1
+        for i in range(0, len(self.text), size):
+            time.sleep(latency / self.chunks)
+            yield _StubResponse(self.text[i:i + size], prompt_tokens)
+
+
+class StubSender:
+    """Pengganti FonnteSender in-process dengan antarmuka send/stats yang sama."""
+
+    def __init__(self, latency_ms: float = 150, dist: str = "fixed", error_rate: float = 0.0):
+        self.latency_ms = latency_ms
+        self.dist = dist
+        self.error_rate = error_rate
+        self._lock = threading.Lock()
+        self._sent = 0
+        self._failed = 0
+
+    def send(self, target: str, message: str):
+        time.sleep(sample_latency(self.latency_ms, self.dist))
+        ok = random.random() >= self.error_rate
+        with self._lock:
+            if ok:
+                self._sent += 1
+            else:
+                self._failed += 1
+        if not ok:
+            return {"sent": False, "error": "stub Fonnte error"}
+        return {"status": True, "target": target}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"backend": "stub", "sent": self._sent, "failed": self._failed}
@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+# app.py membuat log, aira.db, dan thread saat di-import; jalankan di folder sementara dengan backend stub
+os.chdir(tempfile.mkdtemp(prefix="aira-test-"))
+os.environ.setdefault("LLM_BACKEND", "stub")
+os.environ.setdefault("FONNTE_BACKEND", "stub")
+os.environ.setdefault("STUB_LLM_LATENCY_MS", "0")
+os.environ.setdefault("STUB_FONNTE_LATENCY_MS", "0")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,127 @@
+import threading
+import time
+
+import pytest
+
+import app
+
+
+class FakeClock:
+    """Pengganti modul time di app: waktu hanya maju lewat advance()/sleep()."""
+
+    def __init__(self):
+        self.now = 1_000_000.0
+        self.perf_counter = time.perf_counter
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        # Thread latar app (mis. flush metrik) tetap tidur sungguhan supaya tidak memajukan jam test
+        if threading.current_thread() is threading.main_thread():
+            self.now += seconds
+        else:
+            time.sleep(seconds)
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    db = app.get_db()
+    for table in ("rate_buckets", "breaker", "llm_slots"):
+        db.execute(f"DELETE FROM {table}")
+    fake = FakeClock()
+    monkeypatch.setattr(app, "time", fake)
+    monkeypatch.setattr(app, "BREAKER_FAILURES", 3)
+    monkeypatch.setattr(app, "BREAKER_COOLDOWN_SEC", 30)
+    return fake
+
+
+def test_take_token_burst_then_refill(clock):
+    assert app.take_token("t", rate=1, burst=2) == 0
+    assert app.take_token("t", rate=1, burst=2) == 0
+    assert app.take_token("t", rate=1, burst=2) == pytest.approx(1.0)
+    clock.advance(0.5)
+    assert app.take_token("t", rate=1, burst=2) == pytest.approx(0.5)
+    clock.advance(0.5)
+    assert app.take_token("t", rate=1, burst=2) == 0
+
+
+def test_take_token_refill_is_capped_at_burst(clock):
+    app.take_token("t", rate=1, burst=2)
+    clock.advance(3600)
+    assert [app.take_token("t", rate=1, burst=2) for _ in range(3)] == [0, 0, pytest.approx(1.0)]
+
+
+def test_breaker_closed_open_half_open_closed(clock):
+    for _ in range(2):
+        app.breaker_record(False)
+    assert app.breaker_state()[0] == "closed"
+    app.breaker_record(False)
+    assert app.breaker_state()[0] == "open"
+    assert not app.breaker_allow()
+
+    clock.advance(30)
+    assert app.breaker_allow()
+    assert app.breaker_state()[0] == "half_open"
+    # Percobaan half-open yang gagal langsung membuka lagi
+    app.breaker_record(False)
+    assert app.breaker_state()[0] == "open"
+    assert not app.breaker_allow()
+
+    clock.advance(30)
+    assert app.breaker_allow()
+    app.breaker_record(True)
+    assert app.breaker_state()[:2] == ("closed", 0)
+
+
+def test_slow_call_counts_as_failure(clock, monkeypatch):
+    monkeypatch.setattr(app, "LLM_SLO_SEC", 5)
+    with app.llm_guard() as call:
+        call["latency"] = 6
+    assert app.breaker_state()[:2] == ("closed", 1)
+
+    with app.llm_guard() as call:
+        call["latency"] = 1
+    assert app.breaker_state()[:2] == ("closed", 0)
+
+
+def test_open_breaker_rejects_llm_guard(clock):
+    for _ in range(3):
+        app.breaker_record(False)
+    with pytest.raises(app.LlmUnavailable):
+        with app.llm_guard():
+            pass
+
+
+def test_slot_lease_expires(clock, monkeypatch):
+    monkeypatch.setattr(app, "LLM_MAX_INFLIGHT", 1)
+    monkeypatch.setattr(app, "LLM_SLOT_WAIT_SEC", 0.1)
+    monkeypatch.setattr(app, "LLM_SLOT_LEASE_SEC", 90)
+    assert app.acquire_llm_slot() is not None
+    assert app.acquire_llm_slot() is None
+
+    # Proses pemegang slot dianggap mati setelah lease habis
+    clock.advance(91)
+    assert app.acquire_llm_slot() is not None
+
+
+def test_sender_bucket_cleanup_runs_on_interval(clock, monkeypatch):
+    monkeypatch.setattr(app, "SENDER_RATE_PER_MIN", 60)
+    monkeypatch.setattr(app, "SENDER_BURST", 5)
+    monkeypatch.setattr(app, "_buckets_cleaned_at", 0.0)
+
+    def buckets():
+        return {k for (k,) in app.get_db().execute("SELECT key FROM rate_buckets")}
+
+    assert app.allow_sender("a")
+    clock.advance(10)
+    assert app.allow_sender("b")
+    # "a" sudah penuh kembali, tapi pembersihan belum jatuh tempo
+    assert buckets() == {"sender:a", "sender:b"}
+
+    clock.advance(app.SENDER_BUCKET_CLEANUP_SEC)
+    assert app.allow_sender("c")
+    assert buckets() == {"sender:c"}
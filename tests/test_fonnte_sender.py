@@ -0,0 +1,72 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+
+from app import FonnteSender
+
+
+@pytest.fixture
+def fonnte_stub():
+    """Stub HTTP Fonnte yang membalas kode dari server.codes secara berurutan."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+            server.requests.append(parse_qs(body))
+            code = server.codes.pop(0) if server.codes else 200
+            payload = json.dumps({"status": code == 200}).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.codes, server.requests = [], []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def make_sender(fonnte_stub, tmp_path):
+    def make(**kwargs):
+        return FonnteSender(
+            f"http://127.0.0.1:{fonnte_stub.server_port}/send", "token",
+            max_retries=2, backoff_sec=0, deadletter_path=str(tmp_path / "dead.jsonl"), **kwargs,
+        )
+    return make
+
+
+def test_retries_5xx_until_success(fonnte_stub, make_sender):
+    fonnte_stub.codes = [500, 503]
+    sender = make_sender()
+    assert sender.send("62811", "halo") == {"status": True}
+    assert len(fonnte_stub.requests) == 3
+    assert fonnte_stub.requests[0]["target"] == ["62811"]
+    assert sender.stats()["sent"] == 1
+
+
+def test_dead_letter_after_retries_exhausted(fonnte_stub, make_sender, tmp_path):
+    fonnte_stub.codes = [500, 500, 502]
+    sender = make_sender()
+    assert sender.send("62811", "halo") == {"sent": False, "error": "HTTP 502"}
+    assert len(fonnte_stub.requests) == 3
+
+    records = [json.loads(line) for line in (tmp_path / "dead.jsonl").read_text().splitlines()]
+    assert [(r["target"], r["message"], r["error"]) for r in records] == [("62811", "halo", "HTTP 502")]
+    assert sender.stats()["dead_letters"] == 1
+
+
+def test_4xx_is_not_retried(fonnte_stub, make_sender, tmp_path):
+    fonnte_stub.codes = [400]
+    sender = make_sender()
+    assert sender.send("62811", "halo")["sent"] is False
+    assert len(fonnte_stub.requests) == 1
+    assert not (tmp_path / "dead.jsonl").exists()
+    assert sender.stats()["failed"] == 1
@@ -0,0 +1,42 @@
+import pytest
+
+import app
+
+
+@pytest.fixture
+def history(monkeypatch):
+    app.get_db().execute("DELETE FROM turns")
+    app.get_db().execute("DELETE FROM counters WHERE name LIKE 'history:%'")
+    monkeypatch.setattr(app, "HISTORY_ENABLED", True)
+    monkeypatch.setattr(app, "HISTORY_MAX_TURNS", 4)
+    # Pembersihan berkala tidak jalan selama test; yang diuji hanya batas saat simpan
+    monkeypatch.setattr(app, "_history_evicted_at", float("inf"))
+    return app
+
+
+def senders():
+    return [r[0] for r in app.get_db().execute("SELECT DISTINCT sender FROM turns ORDER BY sender")]
+
+
+def test_ring_buffer_keeps_last_turns_and_running_total(history):
+    for i in range(5):
+        history.remember_exchange("a", f"tanya {i}", "jawab é")
+    assert [t.text for t in history.conversation_history("a")] == ["tanya 3", "jawab é", "tanya 4", "jawab é"]
+    assert history.read_counters("history:") == {"senders": 1, "bytes": history.history_stats()["bytes"]}
+
+
+def test_sender_cap_is_enforced_on_insert(history, monkeypatch):
+    monkeypatch.setattr(app, "HISTORY_MAX_SENDERS", 10)
+    for i in range(11):
+        history.remember_exchange(f"s{i:02d}", "halo", "hai")
+    # Lewat batas: pengirim paling lama diam dibuang sampai 90% batas
+    assert senders() == [f"s{i:02d}" for i in range(2, 11)]
+    assert history.read_counters("history:")["senders"] == 9
+
+
+def test_byte_cap_is_enforced_on_insert(history, monkeypatch):
+    monkeypatch.setattr(app, "HISTORY_MAX_BYTES", 100)
+    for i in range(4):
+        history.remember_exchange(f"s{i}", "q" * 20, "a" * 20)
+    assert senders() == ["s2", "s3"]
+    assert history.history_stats()["bytes"] == history.read_counters("history:")["bytes"] == 80
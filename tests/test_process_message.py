@@ -0,0 +1,27 @@
+import pytest
+
+import app
+
+
+@pytest.fixture
+def conversations(monkeypatch):
+    records = []
+    monkeypatch.setattr(app, "log_conversation", lambda *args: records.append(args))
+    monkeypatch.setattr(app, "SENDER_RATE_PER_MIN", 0)
+    return records
+
+
+@pytest.mark.parametrize("stream_mode", [False, True])
+def test_every_reply_logs_one_conv_record_with_raw_message(monkeypatch, conversations, stream_mode):
+    monkeypatch.setattr(app, "STREAM_MODE", stream_mode)
+    message = f"@aigizi Bagaimana cara menambah berat badan anak? (stream={stream_mode})"
+
+    app.process_message("6281200000001", message)
+    # Kirim kedua dari nomor lain dijawab dari cache balasan
+    app.process_message("6281200000002", message)
+
+    assert [(sender, msg, route) for sender, msg, _, route, _ in conversations] == [
+        ("6281200000001", message, "llm"),
+        ("6281200000002", message, "llm"),
+    ]
+    assert conversations[0][2] == conversations[1][2]
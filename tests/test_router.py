@@ -0,0 +1,65 @@
+import pytest
+
+import app
+from app import FaqIndex, route_message
+
+FAQ = [
+    {"questions": ["kapan mulai mpasi", "mpasi mulai usia berapa"], "answer": "mpasi"},
+    {"questions": ["alergi susu sapi", "anak alergi susu"], "answer": "alergi"},
+    {"questions": ["sumber kalsium anak"], "answer": "kalsium"},
+]
+
+
+@pytest.mark.parametrize("message", ["Halo", "selamat pagi", "assalamualaikum kak"])
+def test_greeting(message):
+    assert route_message(message) == ("greeting", app.GREETING_REPLY)
+
+
+@pytest.mark.parametrize("message", ["makan malam anak", "menu sarapan pagi", "halo, bayi boleh minum susu?"])
+def test_greeting_word_in_nutrition_question_is_not_greeting(message):
+    assert route_message(message)[0] not in ("greeting", "identity", "off_topic")
+
+
+def test_identity():
+    assert route_message("siapa namamu?") == ("identity", app.IDENTITY_REPLIES["nama"])
+
+
+def test_identity_mixed_with_nutrition_goes_to_llm():
+    assert route_message("siapa namamu? anak saya susah makan sayur") == ("llm", None)
+
+
+def test_off_topic():
+    assert route_message("siapa capres favoritmu") == ("off_topic", app.OFF_TOPIC_REPLY)
+
+
+def test_off_topic_word_in_nutrition_question_is_answered():
+    assert route_message("boleh makan sambil main game?")[0] != "off_topic"
+
+
+def test_faq():
+    route, reply = route_message("Kapan bayi mulai MPASI?")
+    assert route == "faq"
+    assert "6 bulan" in reply
+
+
+def test_single_word_goes_to_llm():
+    assert route_message("susu") == ("llm", None)
+
+
+def test_faq_index_requires_min_matched_terms():
+    index = FaqIndex(FAQ, min_terms=2)
+    assert index.search("susu") == (None, 0.0)
+    answer, confidence = index.search("alergi susu sapi?")
+    assert answer == "alergi"
+    assert confidence == pytest.approx(1.0)
+
+
+def test_faq_index_confidence_is_share_of_query_covered():
+    index = FaqIndex(FAQ, min_terms=1)
+    answer, confidence = index.search("kapan mulai mpasi untuk bayi kembar")
+    assert answer == "mpasi"
+    assert 0 < confidence < app.FAQ_MIN_CONFIDENCE
+
+
+def test_faq_index_empty():
+    assert FaqIndex([]).search("mpasi") == (None, 0.0)
@@ -0,0 +1,57 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stream_shaper import StreamShaper, clean_reply
+
+
+def feed_all(shaper, chunks):
+    pieces = []
+    for chunk in chunks:
+        pieces += shaper.feed(chunk)
+        if shaper.done:
+            break
+    return pieces + shaper.finish()
+
+
+def test_clean_reply_strips_markdown():
+    assert clean_reply("**Tips** -- makan") == "Tips  makan"
+
+
+def test_markers_split_across_chunks_are_removed():
+    shaper = StreamShaper(max_words=200, min_chars=300, max_chars=1000)
+    pieces = feed_all(shaper, ["Halo *", "*Bunda*", "* ini -", "- tips"])
+    assert pieces == ["Halo Bunda ini  tips"]
+
+
+def test_word_budget_stops_and_appends_ellipsis():
+    shaper = StreamShaper(max_words=5, min_chars=300, max_chars=1000)
+    pieces = shaper.feed("satu dua tiga empat lima enam tujuh")
+    assert shaper.done
+    assert pieces == ["satu dua tiga empat lima..."]
+    assert shaper.feed("delapan") == []
+
+
+def test_pieces_cut_at_sentence_boundary_not_list_number():
+    shaper = StreamShaper(max_words=500, min_chars=20, max_chars=200)
+    pieces = shaper.feed("Ini kalimat pertama yang panjang. 1. poin satu")
+    assert pieces == ["Ini kalimat pertama yang panjang."]
+    assert shaper.finish() == ["1. poin satu"]
+
+
+def test_final_piece_respects_max_chars():
+    sentence = "Berikan sayur dan buah setiap hari ya Bunda. "
+    shaper = StreamShaper(max_words=200, min_chars=300, max_chars=1000)
+    pieces = shaper.feed(sentence * 40)
+    assert shaper.done
+    assert len(pieces) > 1
+    assert all(len(p) <= 1000 for p in pieces)
+    assert " ".join(pieces).split() == shaper.text.split()
+
+
+def test_long_text_without_boundary_is_cut_at_space():
+    shaper = StreamShaper(max_words=1000, min_chars=10, max_chars=50)
+    pieces = feed_all(shaper, ["kata " * 40])
+    assert all(len(p) <= 50 for p in pieces)
+    assert " ".join(pieces).split() == ["kata"] * 40
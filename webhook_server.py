@@ -29,7 +29,8 @@ def webhook():
     res = requests.post(
         "https://api.fonnte.com/send",
         headers={"Authorization": FONNTE_TOKEN},
-        data={"target": sender, "message": reply}
+        data={"target": sender, "message": reply},
+        timeout=10
     )
 
     sent_ok = res.status_code == 200